@@ -1,20 +1,32 @@
 import streamlit as st
 import json
 import os
-import openai
-import re
-import tempfile
-import io
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+import time
 
-# Try to import PyPDF2 for PDF extraction
-try:
-    import PyPDF2
-    HAS_PYPDF2 = True
-except ImportError:
-    HAS_PYPDF2 = False
+from drive_utils import (
+    authenticate_drive,
+    drive_account,
+    drive_client_from_info,
+    get_company_folders,
+    get_file_info,
+    list_files_for_companies,
+)
+from gpt_utils import ask_gpt, retrieve_context
+
+# Parent folder holding one sub-folder per company
+PARENT_FOLDER_ID = "1lQ536qAHRUTt7OT3cd5qzo2RwgL5UgjB"
+
+# Show the secrets checklist in the sidebar. Off by default since it renders
+# a dozen sidebar elements on every rerun; set CHAMPCA_DEBUG=1 to enable.
+DEBUG = os.getenv("CHAMPCA_DEBUG") == "1"
+
+# Characters of a file shown in its preview; the full text still goes to GPT.
+MAX_PREVIEW_CHARS = 50000
+
+# Seconds a file that came back without text is skipped before it is tried
+# again, unless it changes in Drive first. Keeps a broken or rate-limited PDF
+# from being downloaded again on every rerun.
+FAILED_FILE_RETRY_SECONDS = 120
 
 # --- Sidebar Setup ---
 st.set_page_config(page_title="Company Data Chat", layout="wide")
@@ -27,10 +39,11 @@ def debug_secrets():
         # Check if google section exists
         if "google" in st.secrets:
             st.sidebar.success("✅ 'google' section found in secrets")
+            google_secrets = st.secrets["google"]
             
             # Check if service_account_json exists
-            if "service_account_json" in st.secrets["google"]:
-                sa_info = st.secrets["google"]["service_account_json"]
+            if "service_account_json" in google_secrets:
+                sa_info = google_secrets["service_account_json"]
                 if isinstance(sa_info, str):
                     st.sidebar.success(f"✅ 'service_account_json' found (type: string, length: {len(sa_info)})")
                     
@@ -45,7 +58,7 @@ def debug_secrets():
                 st.sidebar.error("❌ 'service_account_json' not found in google section")
                 
             # Check what keys are available
-            keys = list(st.secrets["google"].keys())
+            keys = list(google_secrets.keys())
             st.sidebar.info(f"Available keys in google section: {', '.join(keys)}")
         else:
             st.sidebar.error("❌ 'google' section not found in secrets")
@@ -53,8 +66,9 @@ def debug_secrets():
         # Check if openai section exists
         if "openai" in st.secrets:
             st.sidebar.success("✅ 'openai' section found in secrets")
-            if "api_key" in st.secrets["openai"]:
-                api_key = st.secrets["openai"]["api_key"]
+            openai_secrets = st.secrets["openai"]
+            if "api_key" in openai_secrets:
+                api_key = openai_secrets["api_key"]
                 st.sidebar.success(f"✅ OpenAI API key found (length: {len(api_key)})")
             else:
                 st.sidebar.error("❌ 'api_key' not found in openai section")
@@ -64,208 +78,17 @@ def debug_secrets():
     except Exception as e:
         st.sidebar.error(f"Error debugging secrets: {str(e)}")
 
-# --- Function to extract PDF content ---
-def extract_pdf_content(drive_service, file_id):
-    if not HAS_PYPDF2:
-        return "[PDF extraction requires PyPDF2 library. Add 'PyPDF2' to your requirements.txt.]"
-        
-    try:
-        request = drive_service.files().get_media(fileId=file_id)
-        file_content = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_content, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-        
-        file_content.seek(0)
-        pdf_reader = PyPDF2.PdfReader(file_content)
-        
-        # Extract text from all pages
-        text = ""
-        for page_num in range(len(pdf_reader.pages)):
-            text += pdf_reader.pages[page_num].extract_text() + "\n\n"
-        
-        return text
-    except Exception as e:
-        return f"[Error extracting PDF content: {str(e)}]"
-
-# --- Step 1: Authentication with Google Drive API ---
-def authenticate_drive():
-    try:
-        # Check if we have the google section in secrets
-        if "google" not in st.secrets:
-            st.error("No 'google' section found in secrets.")
-            return None
-            
-        # Check which keys are available
-        available_keys = list(st.secrets["google"].keys())
-        
-        # Try different possible keys for service account info
-        service_account_info = None
-        possible_keys = ["service_account_json", "service_account", "credentials", "auth"]
-        
-        for key in possible_keys:
-            if key in st.secrets["google"]:
-                service_account_info = st.secrets["google"][key]
-                st.success(f"Found credentials using key: {key}")
-                break
-                
-        if service_account_info is None:
-            st.error(f"No service account credentials found. Available keys: {', '.join(available_keys)}")
-            return None
-        
-        # Create a temporary file to store the credentials
-        temp_creds_path = os.path.join(tempfile.gettempdir(), "google_creds.json")
-        
-        # If service_account_info is a string, save it to the temp file
-        if isinstance(service_account_info, str):
-            # Clean up the JSON string
-            service_account_info = service_account_info.replace('\\n', '\n')
-            service_account_info = re.sub(r'[\x00-\x1F\x7F]', '', service_account_info)
-            
-            try:
-                # Try to parse it as JSON
-                creds_dict = json.loads(service_account_info)
-                
-                # Write cleaned JSON to temp file
-                with open(temp_creds_path, 'w') as f:
-                    json.dump(creds_dict, f)
-                    
-                # Use the file for authentication
-                credentials = service_account.Credentials.from_service_account_file(
-                    temp_creds_path, 
-                    scopes=['https://www.googleapis.com/auth/drive']
-                )
-            except json.JSONDecodeError as e:
-                st.error(f"Invalid JSON in service account credentials: {str(e)}")
-                return None
-        else:
-            # If it's already a dict, use it directly
-            try:
-                with open(temp_creds_path, 'w') as f:
-                    json.dump(service_account_info, f)
-                    
-                credentials = service_account.Credentials.from_service_account_file(
-                    temp_creds_path, 
-                    scopes=['https://www.googleapis.com/auth/drive']
-                )
-            except Exception as e:
-                st.error(f"Error writing credentials to file: {str(e)}")
-                return None
-        
-        # Build the Drive API client
-        drive_service = build('drive', 'v3', credentials=credentials)
-        st.success("Successfully authenticated with Google Drive!")
-        return drive_service
-            
-    except Exception as e:
-        st.error(f"Authentication error: {str(e)}")
-        return None
-
-# --- Step 2: Get company folders using Drive API ---
-def get_company_folders(drive_service, parent_folder_id):
-    try:
-        results = drive_service.files().list(
-            q=f"'{parent_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false",
-            fields="files(id, name)"
-        ).execute()
-        
-        folders = results.get('files', [])
-        return {folder['name']: folder['id'] for folder in folders}
-    except Exception as e:
-        st.error(f"Error loading company folders: {str(e)}")
-        return {}
-
-# --- Step 3: List files in a folder ---
-def list_files_in_folder(drive_service, folder_id):
-    try:
-        results = drive_service.files().list(
-            q=f"'{folder_id}' in parents and trashed=false",
-            fields="files(id, name, mimeType, size)"
-        ).execute()
-        
-        files = results.get('files', [])
-        return files
-    except Exception as e:
-        st.error(f"Error listing files: {str(e)}")
-        return []
-
-# --- Step 4: Get file metadata and content ---
-def get_file_info(drive_service, files):
-    result = {}
+def write_stream(chunks):
+    """st.write_stream, with a placeholder fallback for Streamlit < 1.31."""
+    if hasattr(st, "write_stream"):
+        return st.write_stream(chunks)
     
-    for file in files:
-        try:
-            file_id = file['id']
-            file_name = file['name']
-            mime_type = file.get('mimeType', 'unknown')
-            
-            # Handle different file types
-            if 'application/vnd.google-apps.' in mime_type:
-                # Google Workspace files
-                if mime_type == 'application/vnd.google-apps.document':
-                    file_info = f"[Google Doc: {file_name}]"
-                elif mime_type == 'application/vnd.google-apps.spreadsheet':
-                    file_info = f"[Google Sheet: {file_name}]"
-                elif mime_type == 'application/vnd.google-apps.presentation':
-                    file_info = f"[Google Slides: {file_name}]"
-                else:
-                    file_info = f"[Google Workspace file: {file_name}]"
-            elif mime_type == 'application/pdf':
-                # Extract content from PDF
-                file_info = extract_pdf_content(drive_service, file_id)
-            else:
-                # For regular files, just show metadata
-                size = file.get('size', 'unknown size')
-                ext = os.path.splitext(file_name)[1].lower()
-                file_info = f"[File: {file_name}, Type: {mime_type}, Extension: {ext}]"
-                
-            result[file_name] = file_info
-            
-        except Exception as e:
-            st.warning(f"Error processing file {file.get('name', 'unknown')}: {str(e)}")
-            result[file.get('name', f'Unknown file')] = f"[Error: {str(e)}]"
-    
-    return result
-
-# --- Step 5: GPT Interaction ---
-def ask_gpt(context, query):
-    try:
-        # Load OpenAI API key from Streamlit secrets
-        openai.api_key = st.secrets["openai"]["api_key"]
-        
-        # Truncate context if it's too long
-        max_context_length = 16000
-        if len(context) > max_context_length:
-            st.warning(f"Context is too large ({len(context)} chars). Truncating to {max_context_length} chars.")
-            context = context[:max_context_length] + "\n\n[Note: Context was truncated due to size limits]"
-        
-        # Support both v1 and pre-v1 OpenAI API
-        try:
-            # Try v1 API
-            response = openai.chat.completions.create(
-                model="gpt-4.1-nano-2025-04-14",
-                messages=[
-                    {"role": "system", "content": "You are an analyst comparing companies."},
-                    {"role": "user", "content": context},
-                    {"role": "user", "content": query}
-                ]
-            )
-            return response.choices[0].message.content
-        except AttributeError:
-            # Fall back to pre-v1 API
-            response = openai.ChatCompletion.create(
-                model="gpt-4.1-nano-2025-04-14",
-                messages=[
-                    {"role": "system", "content": "You are an analyst comparing companies."},
-                    {"role": "user", "content": context},
-                    {"role": "user", "content": query}
-                ]
-            )
-            return response.choices[0].message["content"]
-    except Exception as e:
-        st.error(f"Error calling OpenAI API: {str(e)}")
-        return "Sorry, I encountered an error while processing your question."
+    placeholder = st.empty()
+    answer = ""
+    for chunk in chunks:
+        answer += chunk
+        placeholder.markdown(answer)
+    return answer
 
 # --- Manual Data Input Function ---
 def add_manual_data():
@@ -285,19 +108,119 @@ def add_manual_data():
     
     return None, None
 
+# --- Company comparison UI, shared by both authentication paths ---
+def render_company_chat(drive, show_manual_input):
+    company_folders = get_company_folders(drive, PARENT_FOLDER_ID)
+    
+    if not company_folders:
+        st.warning("No company folders found. Please check the parent folder ID.")
+        return
+    
+    selected_companies = st.multiselect("Select companies to compare", list(company_folders.keys()))
+    if not selected_companies:
+        st.info("Please select at least one company to begin.")
+        return
+    
+    # List every selected company's files concurrently
+    files_by_company = list_files_for_companies(drive, company_folders, selected_companies)
+    for company in selected_companies:
+        st.subheader(f"📁 {company}")
+        files_list = files_by_company[company]
+        
+        if not files_list:
+            st.warning(f"No files found for {company}.")
+        else:
+            # Only metadata is listed up front; bodies are downloaded on demand
+            for file in files_list:
+                fname = file['name']
+                with st.expander(f"📄 {fname}"):
+                    if st.checkbox("Show content", key=f"show_{file['id']}"):
+                        texts, notes = get_file_info(drive, [file])
+                        content = texts.get(file['id'], notes.get(file['id'], ""))
+                        st.text(content[:MAX_PREVIEW_CHARS])
+                        if len(content) > MAX_PREVIEW_CHARS:
+                            st.caption(f"Preview truncated to the first {MAX_PREVIEW_CHARS} characters.")
+    
+    # Manual data input option
+    manual_documents = {}
+    if show_manual_input:
+        manual_company, manual_data = add_manual_data()
+        if manual_company and manual_data:
+            manual_documents[f"{manual_company} - Manual Data"] = (manual_data, (None, None, manual_data))
+            st.success(f"Added manual data for {manual_company}")
+    
+    # Chat Interface
+    st.markdown("---")
+    st.subheader("💬 Ask questions about the selected companies")
+    user_query = st.text_input("Ask your question:")
+    
+    if user_query:
+        with st.spinner("Thinking..."):
+            # Follow-up questions about the same selection reuse the text
+            # extracted for earlier ones; the key changes when any file does
+            selected_files = [file for company in selected_companies for file in files_by_company[company]]
+            account = drive_account(drive)
+            documents_key = (account,) + tuple(
+                (company, file['id'], file.get('modifiedTime'), file.get('md5Checksum'))
+                for company in selected_companies for file in files_by_company[company]
+            )
+            if st.session_state.get("documents_key") != documents_key:
+                st.session_state["file_texts"] = {}
+                st.session_state["documents_key"] = documents_key
+            file_texts = st.session_state["file_texts"]
+            
+            # File bodies are only fetched once a question needs them, all in
+            # one call so every company's PDFs download in the same pool.
+            # Only extracted text is kept; files without text are skipped for
+            # a while and then retried.
+            failed_files = st.session_state.setdefault("failed_files", {})
+            now = time.time()
+            pending = []
+            for file in selected_files:
+                if file['id'] in file_texts:
+                    continue
+                revision = (file.get('modifiedTime'), file.get('md5Checksum'))
+                failure = failed_files.get((account, file['id']))
+                if failure and failure[0] == revision and now - failure[1] < FAILED_FILE_RETRY_SECONDS:
+                    continue
+                pending.append(file)
+            if pending:
+                texts, _ = get_file_info(drive, pending)
+                file_texts.update(texts)
+                for file in pending:
+                    if file['id'] not in texts:
+                        revision = (file.get('modifiedTime'), file.get('md5Checksum'))
+                        failed_files[(account, file['id'])] = (revision, now)
+            
+            # Only files with extracted text are indexed; metadata stubs
+            # would take retrieval slots from real content
+            documents = {}
+            for company in selected_companies:
+                for file in files_by_company[company]:
+                    if file['id'] in file_texts:
+                        documents[f"{company} - {file['name']}"] = (file_texts[file['id']], (account, file['id'], file.get('modifiedTime')))
+            documents.update(manual_documents)
+            
+            # Only the chunks relevant to the question go to GPT
+            combined_context = retrieve_context(documents, user_query)
+        
+        # Render the answer token by token as it arrives
+        write_stream(ask_gpt(combined_context, user_query))
+
 # --- Main UI ---
 st.title("📊 Company Data Comparison Chat")
 
 # Debug the secrets (doesn't expose sensitive data)
-debug_secrets()
+if DEBUG:
+    debug_secrets()
 
 # Add option for manual data input
 show_manual_input = st.sidebar.checkbox("Add manual financial data")
 
 # Authentication
-drive_service = authenticate_drive()
+drive = authenticate_drive()
 
-if drive_service is None:
+if drive is None:
     st.error("Failed to authenticate with Google Drive. Please check your configuration.")
     
     # Manual credentials input option
@@ -310,117 +233,14 @@ if drive_service is None:
     
     if uploaded_file is not None:
         try:
-            # Save the uploaded file to a temporary location
-            temp_path = os.path.join(tempfile.gettempdir(), "uploaded_creds.json")
-            with open(temp_path, "wb") as f:
-                f.write(uploaded_file.getvalue())
-            
-            # Create credentials from the file
-            credentials = service_account.Credentials.from_service_account_file(
-                temp_path,
-                scopes=['https://www.googleapis.com/auth/drive']
-            )
+            # Parse the uploaded key in memory; nothing is written to disk
+            creds_dict = json.loads(uploaded_file.getvalue())
             
-            # Build the Drive API client
-            drive_service = build('drive', 'v3', credentials=credentials)
+            # Build (or reuse) the Drive API client
+            drive = drive_client_from_info(creds_dict)
             st.success("Successfully authenticated with the uploaded credentials!")
-            
-            # Continue with the rest of the app...
-            # Parent folder ID
-            parent_folder_id = "1lQ536qAHRUTt7OT3cd5qzo2RwgL5UgjB"
-            company_folders = get_company_folders(drive_service, parent_folder_id)
-            
-            if not company_folders:
-                st.warning("No company folders found. Please check the parent folder ID.")
-            else:
-                # Process company folders just like in the main flow
-                selected_companies = st.multiselect("Select companies to compare", list(company_folders.keys()))
-                
-                if selected_companies:
-                    combined_context = ""
-                    for company in selected_companies:
-                        st.subheader(f"📁 {company}")
-                        folder_id = company_folders[company]
-                        
-                        # List files in the folder
-                        files_list = list_files_in_folder(drive_service, folder_id)
-                        
-                        if not files_list:
-                            st.warning(f"No files found for {company}.")
-                        else:
-                            # Get file info
-                            files_info = get_file_info(drive_service, files_list)
-                            
-                            for fname, content in files_info.items():
-                                with st.expander(f"📄 {fname}"):
-                                    st.text_area("File Content", value=content, height=200, key=f"{company}_{fname}")
-                                combined_context += f"\n\n[{company} - {fname}]:\n{content}"
-                    
-                    # Manual data input option
-                    if show_manual_input:
-                        manual_company, manual_data = add_manual_data()
-                        if manual_company and manual_data:
-                            combined_context += f"\n\n[{manual_company} - Manual Data]:\n{manual_data}"
-                            st.success(f"Added manual data for {manual_company}")
-                    
-                    # Chat Interface
-                    st.markdown("---")
-                    st.subheader("💬 Ask questions about the selected companies")
-                    user_query = st.text_input("Ask your question:")
-                    
-                    if user_query:
-                        with st.spinner("Thinking..."):
-                            answer = ask_gpt(combined_context, user_query)
-                            st.success(answer)
-                else:
-                    st.info("Please select at least one company to begin.")
         except Exception as e:
             st.error(f"Error with uploaded credentials: {str(e)}")
-else:
-    # Parent folder ID
-    parent_folder_id = "1lQ536qAHRUTt7OT3cd5qzo2RwgL5UgjB"
-    company_folders = get_company_folders(drive_service, parent_folder_id)
-    
-    if not company_folders:
-        st.warning("No company folders found. Please check the parent folder ID.")
-    else:
-        selected_companies = st.multiselect("Select companies to compare", list(company_folders.keys()))
-        
-        if selected_companies:
-            combined_context = ""
-            for company in selected_companies:
-                st.subheader(f"📁 {company}")
-                folder_id = company_folders[company]
-                
-                # List files in the folder
-                files_list = list_files_in_folder(drive_service, folder_id)
-                
-                if not files_list:
-                    st.warning(f"No files found for {company}.")
-                else:
-                    # Get file info
-                    files_info = get_file_info(drive_service, files_list)
-                    
-                    for fname, content in files_info.items():
-                        with st.expander(f"📄 {fname}"):
-                            st.text_area("File Content", value=content, height=200, key=f"{company}_{fname}")
-                        combined_context += f"\n\n[{company} - {fname}]:\n{content}"
-            
-            # Manual data input option
-            if show_manual_input:
-                manual_company, manual_data = add_manual_data()
-                if manual_company and manual_data:
-                    combined_context += f"\n\n[{manual_company} - Manual Data]:\n{manual_data}"
-                    st.success(f"Added manual data for {manual_company}")
-            
-            # Chat Interface
-            st.markdown("---")
-            st.subheader("💬 Ask questions about the selected companies")
-            user_query = st.text_input("Ask your question:")
-            
-            if user_query:
-                with st.spinner("Thinking..."):
-                    answer = ask_gpt(combined_context, user_query)
-                    st.success(answer)
-        else:
-            st.info("Please select at least one company to begin.")
+
+if drive is not None:
+    render_company_chat(drive, show_manual_input)
@@ -0,0 +1,46 @@
+"""SQLite cache file shared by the Drive and GPT helpers."""
+import functools
+import os
+import sqlite3
+
+# Per-user cache directory; override with CHAMPCA_CACHE_DIR. It holds private
+# PDF text and Drive responses, so it is only readable by the app's user.
+CACHE_DIR = os.getenv("CHAMPCA_CACHE_DIR") or os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "champca"
+)
+
+# SQLite file that keeps PDF text, embeddings and GPT answers across app
+# restarts. Each helper module creates its own tables in it.
+CACHE_DB = os.path.join(CACHE_DIR, "cache.db")
+
+# On-disk HTTP cache so unchanged Drive responses can be revalidated (304)
+# instead of downloaded again.
+HTTP_CACHE_DIR = os.path.join(CACHE_DIR, "http")
+
+def private_dir(path):
+    """Create `path` if needed and make it accessible to the current user only.
+
+    Directories between CACHE_DIR and `path` are made private too, since
+    os.makedirs only applies `mode` to the last one.
+    """
+    if path.startswith(CACHE_DIR + os.sep):
+        private_dir(os.path.dirname(path))
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    os.chmod(path, 0o700)
+    return path
+
+@functools.lru_cache(maxsize=None)
+def _prepare_cache_db():
+    # Create the file as 0600 before SQLite opens it; its journal files
+    # inherit the same permissions
+    private_dir(CACHE_DIR)
+    os.close(os.open(CACHE_DB, os.O_CREAT | os.O_RDWR, 0o600))
+    os.chmod(CACHE_DB, 0o600)
+
+def connect_cache(*schema):
+    """Open CACHE_DB, creating the tables in `schema` if they are missing."""
+    _prepare_cache_db()
+    conn = sqlite3.connect(CACHE_DB)
+    for statement in schema:
+        conn.execute(statement)
+    return conn
@@ -0,0 +1,443 @@
+"""Google Drive helpers shared by the Streamlit app."""
+import streamlit as st
+import json
+import os
+import hashlib
+import io
+import functools
+from collections import namedtuple
+import threading
+import random
+import time
+import sqlite3
+from contextlib import closing
+import httplib2
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.auth.transport.requests import Request
+from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+from googleapiclient.http import build_http
+
+from cache_utils import HTTP_CACHE_DIR, connect_cache, private_dir
+
+# Try to import PyPDF2 for PDF extraction
+try:
+    import PyPDF2
+    HAS_PYPDF2 = True
+except ImportError:
+    HAS_PYPDF2 = False
+
+# Try to import pypdfium2, whose native text extraction is much faster than PyPDF2's
+try:
+    import pypdfium2 as pdfium
+    HAS_PDFIUM = True
+except ImportError:
+    HAS_PDFIUM = False
+
+# Drive calls are I/O bound, so they are fanned out over a thread pool.
+# Capped to stay well inside Drive's per-user request quota.
+MAX_DRIVE_WORKERS = 8
+
+# Number of folders combined into one `in parents` query.
+FOLDER_QUERY_CHUNK_SIZE = 40
+
+# Seconds Drive listings stay cached. The company list changes rarely;
+# files inside a company folder change more often.
+COMPANY_FOLDERS_TTL = 600
+FILE_LISTING_TTL = 300
+
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
+# Keys under [google] in secrets that may hold the service account, in order.
+SERVICE_ACCOUNT_KEYS = ("service_account_json", "service_account", "credentials", "auth")
+
+# Labels for Google Workspace files, which have no downloadable body.
+_GOOGLE_APPS_PREFIX = 'application/vnd.google-apps.'
+_MIME_LABELS = {
+    'application/vnd.google-apps.document': 'Google Doc',
+    'application/vnd.google-apps.spreadsheet': 'Google Sheet',
+    'application/vnd.google-apps.presentation': 'Google Slides',
+}
+
+# Files larger than this are not downloaded; a single huge file would stall
+# the page. Annual-report PDFs are often several MB, so keep this generous.
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+
+# Direct media download endpoint for Drive files.
+DRIVE_MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{}?alt=media"
+
+# Largest page Drive's files.list will return.
+DRIVE_PAGE_SIZE = 1000
+
+# Retries for Drive API calls that hit rate limits (429/403) or 5xx errors.
+# googleapiclient backs off exponentially with jitter between attempts.
+DRIVE_NUM_RETRIES = 3
+
+# Drive query templates
+_FOLDER_Q = "'{}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
+_PARENT_Q = "'{}' in parents"
+# Only PDFs and Google Workspace files carry anything the chat can use, so
+# other files (and sub-folders) are filtered out by Drive rather than listed.
+_FILES_Q = (
+    "({}) and trashed=false"
+    " and (mimeType='application/pdf' or mimeType contains 'google-apps')"
+    " and mimeType!='application/vnd.google-apps.folder'"
+)
+
+# Extracted PDF text in the shared CACHE_DB, keyed by the service account that
+# read it, the file id and the file's revision
+_PDF_TEXT_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS pdf_text "
+    "(account TEXT, file_id TEXT, revision TEXT, created REAL, text TEXT, "
+    "PRIMARY KEY (account, file_id))"
+)
+# Seconds before stored PDF text is pruned, so files that are no longer
+# selected (or were deleted from Drive) don't keep the cache growing.
+PDF_TEXT_CACHE_TTL = 30 * 24 * 3600
+
+# Control characters stripped from service-account JSON pasted into secrets
+_CTRL_TABLE = dict.fromkeys([*range(0x20), 0x7F])
+
+# --- Drive HTTP connections ---
+def _authorized_http(credentials):
+    """Keep-alive Http for Drive calls, backed by the on-disk HTTP cache."""
+    http = build_http()
+    # One cache per service account, so cached responses never cross keys
+    account = hashlib.blake2b(credentials.service_account_email.encode("utf-8"), digest_size=16).hexdigest()
+    http.cache = httplib2.FileCache(private_dir(os.path.join(HTTP_CACHE_DIR, account)))
+    return AuthorizedHttp(credentials, http=http)
+
+# The Drive API client and the credentials it was built from. Downloads and
+# per-thread connections need the credentials, which the client keeps private.
+DriveClient = namedtuple("DriveClient", ["service", "credentials"])
+
+def build_drive_client(credentials):
+    # Use the discovery document bundled with the client library instead of
+    # fetching it from Google on every cold start
+    service = build(
+        'drive', 'v3',
+        http=_authorized_http(credentials),
+        static_discovery=True,
+        cache_discovery=False
+    )
+    return DriveClient(service, credentials)
+
+def drive_account(drive):
+    """Service account behind `drive`.
+
+    Users can upload their own keys, and keys differ in what they can read,
+    so every cached Drive result is keyed on this as well.
+    """
+    return drive.credentials.service_account_email
+
+# Shared connection pool for file downloads, reused across worker threads
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)),
+))
+_token_lock = threading.Lock()
+
+# Drive reports per-user rate limits as 403s, which the session's Retry
+# (429/5xx only) does not cover
+_RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+def _is_rate_limited(response):
+    if response.status_code != 403:
+        return False
+    try:
+        errors = response.json()["error"]["errors"]
+    except (ValueError, KeyError, TypeError):
+        return False
+    return any(error.get("reason") in _RATE_LIMIT_REASONS for error in errors)
+
+def _download_file(drive, file_id):
+    """Download a file's bytes over the pooled session."""
+    credentials = drive.credentials
+    # Refresh once for all threads rather than racing on an expired token
+    with _token_lock:
+        if not credentials.valid:
+            credentials.refresh(Request(SESSION))
+        headers = {"Authorization": f"Bearer {credentials.token}"}
+    
+    for attempt in range(DRIVE_NUM_RETRIES + 1):
+        response = SESSION.get(DRIVE_MEDIA_URL.format(file_id), headers=headers, timeout=60)
+        if attempt < DRIVE_NUM_RETRIES and _is_rate_limited(response):
+            # Same randomized exponential backoff googleapiclient uses
+            time.sleep(random.random() * 2 ** attempt)
+            continue
+        response.raise_for_status()
+        return response.content
+
+_thread_state = threading.local()
+
+def _thread_http(drive):
+    """Authorized Http for the current thread.
+
+    httplib2 connections are not thread-safe, so each worker thread gets its
+    own connection sharing the Drive client's credentials.
+    """
+    credentials = drive.credentials
+    if getattr(_thread_state, "credentials", None) is not credentials:
+        _thread_state.credentials = credentials
+        _thread_state.http = _authorized_http(credentials)
+    return _thread_state.http
+
+# One worker pool for the whole process. Reusing its threads across reruns
+# keeps each worker's Drive connection (see _thread_http) warm.
+_drive_pool = ThreadPoolExecutor(max_workers=MAX_DRIVE_WORKERS, thread_name_prefix="drive")
+
+# PDFium is not thread-safe, so pool workers take turns parsing while their
+# downloads still overlap.
+_pdfium_lock = threading.Lock()
+
+def _pdfium_text(data):
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(data)
+        try:
+            return "\n\n".join(page.get_textpage().get_text_range() for page in pdf)
+        finally:
+            pdf.close()
+
+# --- Function to extract PDF content ---
+# Cached so reruns (every widget interaction) don't re-download file bodies.
+# Keyed on modifiedTime and md5Checksum, so a file is fetched again only
+# after its bytes change. Extracted text is also kept in CACHE_DB so app
+# restarts don't download and parse unchanged PDFs again.
+# The leading underscore tells Streamlit not to hash the Drive client; the
+# `account` argument keeps results from different keys apart instead.
+# Failures raise so they are never cached; get_file_info reports them.
+@st.cache_data(show_spinner=False)
+def extract_pdf_content(_drive, account, file_id, modified_time, md5_checksum=None):
+    # Text extracted by an earlier process for the same file contents
+    revision = md5_checksum or modified_time
+    text = _load_pdf_text(account, file_id, revision)
+    if text is not None:
+        return text
+    
+    data = _download_file(_drive, file_id)
+    if HAS_PDFIUM:
+        text = _pdfium_text(data)
+    else:
+        # Extract text from all pages
+        pdf_reader = PyPDF2.PdfReader(io.BytesIO(data))
+        text = "\n\n".join(page.extract_text() for page in pdf_reader.pages)
+    
+    _save_pdf_text(account, file_id, revision, text)
+    return text
+
+# --- Step 1: Authentication with Google Drive API ---
+@functools.lru_cache(maxsize=4)
+def _parse_service_account_json(raw):
+    """Clean up and parse a service-account JSON string, once per secret."""
+    cleaned = raw.replace('\\n', '\n').translate(_CTRL_TABLE)
+    return json.loads(cleaned)
+
+# Built once per service account and shared across reruns and sessions.
+# Errors propagate out, so a failed build is retried on the next rerun.
+@st.cache_resource(show_spinner=False)
+def drive_client_from_info(service_account_info):
+    credentials = service_account.Credentials.from_service_account_info(
+        service_account_info,
+        scopes=DRIVE_SCOPES
+    )
+    return build_drive_client(credentials)
+
+def authenticate_drive():
+    try:
+        # Check if we have the google section in secrets; read it only once
+        if "google" not in st.secrets:
+            st.error("No 'google' section found in secrets.")
+            return None
+        google_secrets = dict(st.secrets["google"])
+        
+        # Try different possible keys for service account info
+        key = next((k for k in SERVICE_ACCOUNT_KEYS if k in google_secrets), None)
+        if key is None:
+            st.error(f"No service account credentials found. Available keys: {', '.join(google_secrets)}")
+            return None
+        service_account_info = google_secrets[key]
+        st.success(f"Found credentials using key: {key}")
+        
+        if isinstance(service_account_info, str):
+            try:
+                creds_dict = _parse_service_account_json(service_account_info)
+            except json.JSONDecodeError as e:
+                st.error(f"Invalid JSON in service account credentials: {str(e)}")
+                return None
+        else:
+            # Already parsed from TOML; use it directly
+            creds_dict = dict(service_account_info)
+        
+        # Build (or reuse) the Drive API client
+        drive = drive_client_from_info(creds_dict)
+        st.success("Successfully authenticated with Google Drive!")
+        return drive
+            
+    except Exception as e:
+        st.error(f"Authentication error: {str(e)}")
+        return None
+
+# --- Drive listing helper ---
+def _list_all_files(drive, http=None, **list_kwargs):
+    """Run a files.list query, following nextPageToken until every page is read."""
+    files = []
+    request = drive.service.files().list(
+        pageSize=DRIVE_PAGE_SIZE,
+        spaces='drive',
+        supportsAllDrives=False,
+        **list_kwargs
+    )
+    while request is not None:
+        response = request.execute(http=http, num_retries=DRIVE_NUM_RETRIES)
+        files.extend(response.get('files', []))
+        request = drive.service.files().list_next(request, response)
+    return files
+
+# --- Step 2: Get company folders using Drive API ---
+# Listings are cached for a few minutes so reruns don't hit Drive again.
+# Failures raise inside the cached helpers so they are never cached, and
+# results are keyed on the service account as well as the folder.
+@st.cache_data(ttl=COMPANY_FOLDERS_TTL, show_spinner=False)
+def _fetch_company_folders(_drive, account, parent_folder_id):
+    folders = _list_all_files(
+        _drive,
+        http=_thread_http(_drive),
+        q=_FOLDER_Q.format(parent_folder_id),
+        fields="nextPageToken, files(id, name)"
+    )
+    return {folder['name']: folder['id'] for folder in folders}
+
+def get_company_folders(drive, parent_folder_id):
+    try:
+        return _fetch_company_folders(drive, drive_account(drive), parent_folder_id)
+    except Exception as e:
+        st.error(f"Error loading company folders: {str(e)}")
+        return {}
+
+# --- Step 3: List files in the company folders ---
+@st.cache_data(ttl=FILE_LISTING_TTL, show_spinner=False)
+def _fetch_files_in_folders(_drive, account, folder_ids):
+    """List the children of several folders with one OR'd `in parents` query."""
+    parents_query = " or ".join(_PARENT_Q.format(folder_id) for folder_id in folder_ids)
+    files = _list_all_files(
+        _drive,
+        http=_thread_http(_drive),
+        q=_FILES_Q.format(parents_query),
+        fields="nextPageToken, files(id, name, mimeType, size, modifiedTime, md5Checksum, parents)"
+    )
+    
+    # Group the combined results back by the folder they belong to
+    files_by_folder = {folder_id: [] for folder_id in folder_ids}
+    for file in files:
+        for parent_id in file.get('parents', []):
+            if parent_id in files_by_folder:
+                files_by_folder[parent_id].append(file)
+    return files_by_folder
+
+def list_files_for_companies(drive, company_folders, companies):
+    """List the files of several company folders in as few Drive calls as possible."""
+    folder_ids = sorted({company_folders[company] for company in companies})
+    # Keep each query comfortably under Drive's query length limit
+    chunks = [
+        tuple(folder_ids[i:i + FOLDER_QUERY_CHUNK_SIZE])
+        for i in range(0, len(folder_ids), FOLDER_QUERY_CHUNK_SIZE)
+    ]
+    
+    files_by_folder = {}
+    futures = [_drive_pool.submit(_fetch_files_in_folders, drive, drive_account(drive), chunk) for chunk in chunks]
+    for future in as_completed(futures):
+        try:
+            files_by_folder.update(future.result())
+        except Exception as e:
+            st.error(f"Error listing files: {str(e)}")
+    
+    return {company: files_by_folder.get(company_folders[company], []) for company in companies}
+
+# --- Step 4: Get file metadata and content ---
+def get_file_info(drive, files):
+    """Extracted text and metadata stubs for `files`, as `(texts, notes)`.
+
+    `texts` maps file ids to text extracted from their PDFs. Every other
+    file (Workspace files, oversized PDFs, failed extractions) gets a short
+    stub in `notes` instead, for display only. PDFs are downloaded
+    concurrently, so pass every file that is needed in one call rather than
+    one call per folder.
+    """
+    texts = {}
+    notes = {}
+    pdf_futures = {}
+    
+    for file in files:
+        try:
+            file_id = file['id']
+            file_name = file['name']
+            mime_type = file.get('mimeType', 'unknown')
+            
+            # Handle different file types
+            label = _MIME_LABELS.get(mime_type)
+            if label:
+                notes[file_id] = f"[{label}: {file_name}]"
+            elif mime_type.startswith(_GOOGLE_APPS_PREFIX):
+                notes[file_id] = f"[Google Workspace file: {file_name}]"
+            elif int(file.get('size') or 0) > MAX_DOWNLOAD_BYTES:
+                notes[file_id] = f"[File too large: {file_name}, {file['size']} bytes]"
+            elif not (HAS_PDFIUM or HAS_PYPDF2):
+                notes[file_id] = "[PDF extraction requires pypdfium2 or PyPDF2. Add one to your requirements.txt.]"
+            else:
+                # _FILES_Q only lists PDFs and Workspace files, so this is a
+                # PDF; downloads run concurrently
+                pdf_futures[file_id] = file_name, _drive_pool.submit(
+                    extract_pdf_content, drive, drive_account(drive), file_id,
+                    file.get('modifiedTime'), file.get('md5Checksum')
+                )
+            
+        except Exception as e:
+            st.warning(f"Error processing file {file.get('name', 'unknown')}: {str(e)}")
+            notes[file.get('id')] = f"[Error: {str(e)}]"
+    
+    # Collect PDF text once all downloads have finished
+    for file_id, (file_name, future) in pdf_futures.items():
+        try:
+            texts[file_id] = future.result()
+        except Exception as e:
+            st.warning(f"Error processing file {file_name}: {str(e)}")
+            notes[file_id] = f"[Error extracting PDF content: {str(e)}]"
+    
+    return texts, notes
+
+# --- On-disk cache ---
+def _cache_db():
+    return connect_cache(_PDF_TEXT_SCHEMA)
+
+def _load_pdf_text(account, file_id, revision):
+    """Persisted text of a PDF, or None if missing or from an older revision."""
+    try:
+        with closing(_cache_db()) as conn:
+            row = conn.execute(
+                "SELECT revision, text FROM pdf_text WHERE account = ? AND file_id = ?",
+                (account, file_id)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    
+    if row is None or row[0] != revision:
+        return None
+    return row[1]
+
+def _save_pdf_text(account, file_id, revision, text):
+    try:
+        with closing(_cache_db()) as conn, conn:
+            now = time.time()
+            conn.execute("DELETE FROM pdf_text WHERE created <= ?", (now - PDF_TEXT_CACHE_TTL,))
+            conn.execute(
+                "INSERT OR REPLACE INTO pdf_text VALUES (?, ?, ?, ?, ?)",
+                (account, file_id, revision, now, text)
+            )
+    except sqlite3.Error:
+        # The on-disk copy is only an optimisation
+        pass
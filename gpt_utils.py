@@ -0,0 +1,351 @@
+"""OpenAI chat and retrieval helpers shared by the Streamlit app."""
+import streamlit as st
+import json
+import openai
+import re
+import hashlib
+import time
+import sqlite3
+from contextlib import closing
+import numpy as np
+
+from cache_utils import connect_cache
+
+# Try to import tiktoken for token-accurate context truncation
+try:
+    import tiktoken
+    HAS_TIKTOKEN = True
+except ImportError:
+    HAS_TIKTOKEN = False
+
+# OpenAI model and the share of its input window given to file context.
+GPT_MODEL = "gpt-4.1-nano-2025-04-14"
+# Leads the system message; the file context follows it in the same message.
+SYSTEM_PROMPT = "You are an analyst comparing companies."
+MAX_CONTEXT_TOKENS = 16000
+# Character budget used when tiktoken is not installed.
+MAX_CONTEXT_CHARS = 16000
+
+# Retrieval: files are split into overlapping chunks and only the chunks
+# closest to the question are sent to GPT.
+EMBEDDING_MODEL = "text-embedding-3-small"
+CHUNK_TOKENS = 256
+CHUNK_OVERLAP_TOKENS = 64
+TOP_K_CHUNKS = 8
+# Inputs per embeddings request (the API accepts up to 2048).
+EMBEDDING_BATCH_SIZE = 512
+
+# Seconds a cached GPT answer is reused for an identical question.
+RESPONSE_CACHE_TTL = 3600
+
+# Tables this module keeps in the shared CACHE_DB. Embeddings are keyed on the
+# service account and file, and only reused for the same revision and text.
+_EMBEDDINGS_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS embeddings "
+    "(account TEXT, file_id TEXT, modified_time TEXT, label TEXT, text_hash TEXT, "
+    "chunks TEXT, vectors BLOB, PRIMARY KEY (account, file_id))"
+)
+_RESPONSES_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS responses "
+    "(key TEXT PRIMARY KEY, created REAL, answer TEXT)"
+)
+
+# Sentence boundary that doesn't split decimals such as "12.5"
+_SENTENCE_RE = re.compile(r'(?<=[.!?])\s+(?=[A-Z])')
+
+def _cache_db():
+    return connect_cache(_EMBEDDINGS_SCHEMA, _RESPONSES_SCHEMA)
+
+# --- Step 5: GPT Interaction ---
+@st.cache_resource(show_spinner=False)
+def get_openai_client():
+    """OpenAI v1 client built once per process so connections are reused.
+
+    Raises AttributeError on pre-v1 SDKs, which callers use to fall back to
+    the module-level API.
+    """
+    return openai.OpenAI(
+        api_key=st.secrets["openai"]["api_key"],
+        timeout=30.0,
+        max_retries=2
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_token_encoder():
+    """Tokenizer for GPT_MODEL, loaded once per process."""
+    try:
+        return tiktoken.encoding_for_model(GPT_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def _response_cache_key(messages):
+    payload = json.dumps([GPT_MODEL, messages])
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=32).hexdigest()
+
+def _load_response(key):
+    try:
+        with closing(_cache_db()) as conn:
+            row = conn.execute(
+                "SELECT answer FROM responses WHERE key = ? AND created > ?",
+                (key, time.time() - RESPONSE_CACHE_TTL)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+def _save_response(key, answer):
+    try:
+        with closing(_cache_db()) as conn, conn:
+            now = time.time()
+            # Expired answers are never served again, so drop them here
+            conn.execute("DELETE FROM responses WHERE created <= ?", (now - RESPONSE_CACHE_TTL,))
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                (key, now, answer)
+            )
+    except sqlite3.Error:
+        pass
+
+def ask_gpt(context, query):
+    """Answer `query` from `context`, yielding the reply as it streams in.
+
+    Answers are cached on the exact model and messages, so asking the same
+    question about the same selection again skips the OpenAI call.
+    """
+    try:
+        # Load OpenAI API key from Streamlit secrets (used by the pre-v1 API)
+        openai.api_key = st.secrets["openai"]["api_key"]
+        
+        # Truncate context if it's too long for the model's input budget
+        if HAS_TIKTOKEN:
+            encoder = get_token_encoder()
+            tokens = encoder.encode(context, disallowed_special=())
+            if len(tokens) > MAX_CONTEXT_TOKENS:
+                st.warning(f"Context is too large ({len(tokens)} tokens). Truncating to {MAX_CONTEXT_TOKENS} tokens.")
+                context = encoder.decode(tokens[:MAX_CONTEXT_TOKENS]) + "\n\n[Note: Context was truncated due to size limits]"
+        elif len(context) > MAX_CONTEXT_CHARS:
+            st.warning(f"Context is too large ({len(context)} chars). Truncating to {MAX_CONTEXT_CHARS} chars.")
+            context = context[:MAX_CONTEXT_CHARS] + "\n\n[Note: Context was truncated due to size limits]"
+        
+        # Fixed instructions first, so requests share the longest possible
+        # prefix for OpenAI's prompt caching
+        messages = [
+            {"role": "system", "content": f"{SYSTEM_PROMPT}\n\n{context}"},
+            {"role": "user", "content": query}
+        ]
+        
+        cache_key = _response_cache_key(messages)
+        cached_answer = _load_response(cache_key)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+        
+        answer_parts = []
+        # Support both v1 and pre-v1 OpenAI API
+        try:
+            # Try v1 API
+            response = get_openai_client().chat.completions.create(model=GPT_MODEL, messages=messages, stream=True)
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    answer_parts.append(chunk.choices[0].delta.content)
+                    yield answer_parts[-1]
+        except AttributeError:
+            # Fall back to pre-v1 API
+            response = openai.ChatCompletion.create(model=GPT_MODEL, messages=messages, stream=True)
+            for chunk in response:
+                answer_parts.append(chunk.choices[0].delta.get("content", ""))
+                yield answer_parts[-1]
+        
+        # Only answers that streamed to completion are cached
+        _save_response(cache_key, "".join(answer_parts))
+    except Exception as e:
+        st.error(f"Error calling OpenAI API: {str(e)}")
+        yield "Sorry, I encountered an error while processing your question."
+
+# --- Step 6: Retrieve the chunks relevant to a question ---
+def _count_tokens(text):
+    if HAS_TIKTOKEN:
+        return len(get_token_encoder().encode(text, disallowed_special=()))
+    # Rough estimate when tiktoken is unavailable
+    return len(text) // 4 + 1
+
+def _hard_split(text, size):
+    """Cut `text` into pieces of at most `size` tokens, ignoring whitespace."""
+    if HAS_TIKTOKEN:
+        encoder = get_token_encoder()
+        tokens = encoder.encode(text, disallowed_special=())
+        for i in range(0, len(tokens), size):
+            piece = tokens[i:i + size]
+            yield encoder.decode(piece), len(piece)
+        return
+    # Without tiktoken a token is estimated as 4 characters (see _count_tokens)
+    width = max(1, (size - 1) * 4)
+    for i in range(0, len(text), width):
+        piece = text[i:i + width]
+        yield piece, _count_tokens(piece)
+
+def _split_sentences(text, size):
+    """Sentences of `text` of at most `size` tokens each.
+
+    Longer sentences are cut by words, and pieces that are still too long
+    (such as runs without whitespace) are cut by tokens.
+    """
+    for sentence in _SENTENCE_RE.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        tokens = _count_tokens(sentence)
+        if tokens <= size:
+            yield sentence, tokens
+            continue
+        # PDF text often has no punctuation for long stretches
+        words = sentence.split()
+        step = max(1, len(words) * size // tokens)
+        for i in range(0, len(words), step):
+            piece = " ".join(words[i:i + step])
+            tokens = _count_tokens(piece)
+            if tokens <= size:
+                yield piece, tokens
+            else:
+                yield from _hard_split(piece, size)
+
+def chunk_text(text, size=CHUNK_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    """Split text into ~`size`-token chunks on sentence boundaries, overlapping by ~`overlap` tokens."""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for sentence, tokens in _split_sentences(text, size):
+        if current and current_tokens + tokens > size:
+            chunks.append(" ".join(s for s, _ in current))
+            # Carry the trailing sentences over into the next chunk, leaving
+            # room for this sentence so no chunk grows past `size`
+            while current and (current_tokens > overlap or current_tokens + tokens > size):
+                current_tokens -= current.pop(0)[1]
+        current.append((sentence, tokens))
+        current_tokens += tokens
+    if current:
+        chunks.append(" ".join(s for s, _ in current))
+    return chunks
+
+def _create_embeddings(texts):
+    # Used by the pre-v1 API; v1 calls go through the shared client
+    openai.api_key = st.secrets["openai"]["api_key"]
+    
+    # Support both v1 and pre-v1 OpenAI API
+    try:
+        response = get_openai_client().embeddings.create(model=EMBEDDING_MODEL, input=texts)
+        return [item.embedding for item in response.data]
+    except AttributeError:
+        response = openai.Embedding.create(model=EMBEDDING_MODEL, input=texts)
+        return [item["embedding"] for item in response["data"]]
+
+def embed_many(texts, batch_size=EMBEDDING_BATCH_SIZE):
+    """Embed `texts` in as few requests as possible.
+
+    Returns a unit-normalized float32 (N, D) array, so cosine similarity is
+    a plain dot product.
+    """
+    vectors = []
+    for i in range(0, len(texts), batch_size):
+        vectors.extend(_create_embeddings(texts[i:i + batch_size]))
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+# The question stays in the text box across reruns, so its embedding is
+# cached rather than requested again on every widget interaction.
+@st.cache_data(show_spinner=False, max_entries=256)
+def embed_query(query):
+    return embed_many([query])[0]
+
+def _text_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+def _load_embeddings(account, file_id, modified_time, label, text_hash):
+    """Persisted chunks and vectors for a file, or None if missing or stale."""
+    try:
+        with closing(_cache_db()) as conn:
+            row = conn.execute(
+                "SELECT modified_time, label, text_hash, chunks, vectors "
+                "FROM embeddings WHERE account = ? AND file_id = ?",
+                (account, file_id)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    
+    if row is None or row[:3] != (modified_time, label, text_hash):
+        return None
+    chunks = json.loads(row[3])
+    vectors = np.frombuffer(row[4], dtype=np.float32).reshape(len(chunks), -1)
+    return chunks, vectors
+
+def _save_embeddings(account, file_id, modified_time, label, text_hash, chunks, vectors):
+    try:
+        with closing(_cache_db()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (account, file_id, modified_time, label, text_hash, json.dumps(chunks), vectors.tobytes())
+            )
+    except sqlite3.Error:
+        # The on-disk copy is only an optimisation
+        pass
+
+@st.cache_data(show_spinner=False)
+def index_document(label, version, _text):
+    """Labelled chunks of one document and their embeddings.
+
+    `version` is the Drive `(account, file_id, modifiedTime)` triple, where
+    `account` is the service account that read the file, so a file is only
+    re-chunked and re-embedded after it changes. Drive files are also
+    persisted to CACHE_DB so restarts don't pay for embeddings again; the
+    stored row is only reused for the exact same text. Documents without a
+    file id (manual data) are only cached in memory. Pass extracted text
+    only, never error or metadata stubs.
+    """
+    account, file_id, modified_time = version
+    if file_id is not None:
+        text_hash = _text_hash(_text)
+        persisted = _load_embeddings(account, file_id, modified_time, label, text_hash)
+        if persisted is not None:
+            return persisted
+    
+    chunks = [f"[{label}]:\n{chunk}" for chunk in chunk_text(_text)]
+    if not chunks:
+        return chunks, None
+    vectors = embed_many(chunks)
+    if file_id is not None:
+        _save_embeddings(account, file_id, modified_time, label, text_hash, chunks, vectors)
+    return chunks, vectors
+
+def retrieve_context(documents, query, top_k=TOP_K_CHUNKS):
+    """Build a GPT context from the chunks of `documents` closest to `query`.
+
+    `documents` maps a label such as "Company - file.pdf" to a
+    `(text, version)` pair, where `version` identifies the revision of the
+    text for caching. If embedding fails the full documents are returned
+    instead.
+    """
+    try:
+        labelled_chunks = []
+        vectors = []
+        for label, (text, version) in documents.items():
+            chunks, chunk_vectors = index_document(label, version, text)
+            if chunks:
+                labelled_chunks.extend(chunks)
+                vectors.append(chunk_vectors)
+        if not labelled_chunks:
+            return ""
+        
+        # Cosine similarity between the question and every chunk; vectors
+        # are already normalized, so this is one matrix-vector product
+        scores = np.vstack(vectors) @ embed_query(query)
+        if len(scores) > top_k:
+            top = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            top = np.arange(len(scores))
+        
+        # Keep the selected chunks in document order
+        return "\n\n".join(labelled_chunks[i] for i in sorted(top))
+    except Exception as e:
+        st.warning(f"Retrieval failed, sending full file contents instead: {str(e)}")
+        return "".join(f"\n\n[{label}]:\n{text}" for label, (text, _) in documents.items())